@@ -33,6 +33,7 @@ export default function App() {
 
   // --- Chat State ---
   const [chatPlantName, setChatPlantName] = useState('your plant');
+  const [chatSessionId, setChatSessionId] = useState(() => crypto.randomUUID());
   const [chatInput, setChatInput] = useState('');
   const [chatMessages, setChatMessages] = useState([]);
   const [isChatLoading, setIsChatLoading] = useState(false);
@@ -129,6 +130,7 @@ export default function App() {
       if (response.data.plant_data?.length > 0 && !response.data.plant_data[0].error) {
         const plantName = response.data.plant_data[0].name || 'your plant';
         setChatPlantName(plantName);
+        setChatSessionId(crypto.randomUUID());
         setChatMessages([{ sender: 'bot', text: `I've identified ${plantName}. Ask me anything about it!` }]);
       } else {
         setChatMessages([{ sender: 'bot', text: "I couldn't detect a specific plant." }]);
@@ -153,6 +155,7 @@ export default function App() {
 
     try {
       const response = await axios.post(`${API_URL}/chat`, {
+        session_id: chatSessionId,
         plant_name: chatPlantName,
         message: chatInput,
       });
@@ -7,24 +7,61 @@
 import os
 import json
 import cv2
-import io
 import base64
+import asyncio
+import shutil
+import tempfile
+import threading
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import uvicorn
+import torch
 import google.generativeai as genai
 from ultralytics import YOLO
 from dotenv import load_dotenv
+from cachetools import TTLCache
 from PIL import Image
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+from typing_extensions import TypedDict
 
 # --- 0. Pydantic Models for Request/Response ---
 # This defines the data shape for the /chat endpoint
 class ChatRequest(BaseModel):
+    session_id: str
     plant_name: str
     message: str
 
+# This is the JSON schema Gemini must follow for plant details
+class PlantInfo(TypedDict):
+    scientific_name: str
+    common_name: str
+    local_name: str
+    family_name: str
+    genus: str
+    native_location: str
+    medicinal_uses: str
+
+# This defines the data shape returned by the /predict endpoint
+# (error entries only carry "name" and "error")
+class PlantData(BaseModel):
+    name: str | None = None
+    scientific_name: str | None = None
+    common_name: str | None = None
+    local_name: str | None = None
+    family_name: str | None = None
+    genus: str | None = None
+    native_location: str | None = None
+    medicinal_uses: str | None = None
+    error: str | None = None
+
+class PredictResponse(BaseModel):
+    annotated_image: str
+    plant_data: list[PlantData]
+
 # --- 1. LOAD ENVIRONMENT VARIABLES and CONFIGURE API KEY ---
 load_dotenv() 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
@@ -33,29 +70,117 @@ if not GEMINI_API_KEY:
     print("❌ ERROR: GEMINI_API_KEY not found. Please check your .env file in the 'backend' folder.")
     GEMINI_CONFIGURED = False
 else:
-    genai.configure(api_key=GEMINI_API_KEY)
+    # All Gemini calls are async, so share one persistent grpc.aio (HTTP/2) channel between them
+    genai.configure(api_key=GEMINI_API_KEY, transport="grpc_asyncio")
     print("✅ Gemini API configured successfully.")
     GEMINI_CONFIGURED = True
 
 # --- 2. LOAD YOUR MODELS (YOLO and Gemini) ---
 model_path = 'best.pt' # Assumes 'best.pt' is in the same 'backend' folder
+engine_path = 'best.engine' # TensorRT engine, built from 'best.pt' on first start
+calib_data_path = 'calib.yaml' # Optional dataset YAML of plant images for INT8 calibration
+# Run on the first GPU in FP16 when one is available, otherwise on the CPU in FP32
+YOLO_DEVICE = 0 if torch.cuda.is_available() else 'cpu'
+YOLO_HALF = torch.cuda.is_available()
 
-try:
-    yolo_model = YOLO(model_path)
-    print("✅ YOLOv8 model loaded successfully.")
-except Exception as e:
-    print(f"❌ ERROR: Could not load the YOLO model from {model_path}. Make sure 'best.pt' is in the 'backend' folder. Error: {e}")
+def _export_engine(**export_args):
+    """
+    Exports a copy of 'best.pt' in a temporary folder and renames the result into place,
+    so a half-written file is never visible at engine_path.
+    """
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(engine_path))) as tmp_dir:
+        tmp_model_path = shutil.copy(model_path, tmp_dir)
+        exported_path = YOLO(tmp_model_path).export(format='engine', dynamic=True, batch=8, imgsz=640, **export_args)
+        os.replace(exported_path, engine_path)
+
+def build_tensorrt_engine():
+    """
+    Exports 'best.pt' to a TensorRT engine once, if a GPU is available.
+    Uses INT8 when 'calib.yaml' is present, otherwise (or if INT8 fails) FP16.
+    Only called from the launcher (see section 9); workers just load the result.
+    """
+    if os.path.exists(engine_path) or not torch.cuda.is_available():
+        return
+    if os.path.exists(calib_data_path):
+        try:
+            print(f"Building TensorRT INT8 engine, calibrating on {calib_data_path} (one-time step)...")
+            _export_engine(int8=True, data=calib_data_path)
+            print(f"✅ TensorRT INT8 engine saved to {engine_path}.")
+            return
+        except Exception as e:
+            print(f"⚠️ WARNING: TensorRT INT8 export failed, trying FP16 instead. Error: {e}")
+    try:
+        print("Building TensorRT FP16 engine (one-time step)...")
+        _export_engine(half=True)
+        print(f"✅ TensorRT engine saved to {engine_path}.")
+    except Exception as e:
+        print(f"⚠️ WARNING: TensorRT export failed, falling back to {model_path}. Error: {e}")
+
+def get_worker_count():
+    """
+    Number of server worker processes: WEB_CONCURRENCY if set, otherwise a small default.
+    Each worker holds its own model and batch queue, so a GPU host gets one worker
+    (one CUDA context, one shared batch) and a CPU host gets two.
+    """
+    return int(os.getenv("WEB_CONCURRENCY", 1 if torch.cuda.is_available() else 2))
+
+# The YOLO model is loaded per worker process in the app's lifespan (CUDA state isn't fork-safe)
+yolo_model = None
+YOLO_CLASS_NAMES = []
+
+def _load_and_warm_up(path):
+    """Loads a YOLO model (or TensorRT engine) and warms it up with dummy frames."""
+    model = YOLO(path, task='detect')
+    # Warm up with dummy frames so the first real request doesn't pay for autotuning/allocation
+    for _ in range(2):
+        model(np.zeros((640, 640, 3), dtype=np.uint8), half=YOLO_HALF, device=YOLO_DEVICE, imgsz=640, verbose=False)
+    return model
+
+def load_yolo_model():
+    """Loads (and warms up) the YOLO model for this worker process."""
+    global yolo_model, YOLO_CLASS_NAMES
     yolo_model = None
+    YOLO_CLASS_NAMES = []
+
+    # Split the CPU cores between workers instead of every worker's torch using all of them
+    torch.set_num_threads(max(1, os.cpu_count() // get_worker_count()))
+
+    # The engine only runs on a GPU, and may be stale (built for another TensorRT/driver version)
+    if os.path.exists(engine_path) and torch.cuda.is_available():
+        try:
+            yolo_model = _load_and_warm_up(engine_path)
+            print("✅ YOLOv8 TensorRT engine loaded and warmed up.")
+        except Exception as e:
+            print(f"⚠️ WARNING: Could not load the TensorRT engine from {engine_path}, falling back to {model_path}. Error: {e}")
+
+    if yolo_model is None:
+        try:
+            yolo_model = _load_and_warm_up(model_path)
+            print("✅ YOLOv8 model loaded and warmed up.")
+        except Exception as e:
+            print(f"❌ ERROR: Could not load the YOLO model from {model_path}. Make sure 'best.pt' is in the 'backend' folder. Error: {e}")
+            return
+
+    # Class id -> name as a plain list, so detections are looked up by index
+    YOLO_CLASS_NAMES = [yolo_model.names[i] for i in range(len(yolo_model.names))]
 
 # Personas for Gemini
-botanist_persona = "You are a world-class botanist. For any plant name given, you must respond only with a JSON object containing the requested details."
+# The fixed instructions live in the system instruction so each request only adds the plant name
+botanist_persona = (
+    "You are a world-class botanist. For any plant name given, you must respond only with a JSON object containing the requested details. "
+    'For "medicinal_uses", provide a brief summary. If information for any key is not found, use "N/A".'
+)
 chat_persona = "You are a helpful and expert botanist. The user has just identified a plant. Answer their follow-up questions clearly and concisely."
 
 try:
     # Model for JSON data extraction
     gemini_data_model = genai.GenerativeModel(
         'gemini-2.0-flash',
-        system_instruction=botanist_persona
+        system_instruction=botanist_persona,
+        generation_config={
+            "response_mime_type": "application/json",
+            "response_schema": PlantInfo,
+        }
     )
     # Model for follow-up chat
     gemini_chat_model = genai.GenerativeModel(
@@ -69,32 +194,152 @@ except Exception as e:
     gemini_chat_model = None
 
 # --- 3. HELPER FUNCTION TO GET INFO FROM GEMINI ---
-def get_plant_info_from_gemini(plant_name: str):
+# Cache successful lookups per plant name for 24h so repeat species skip the API call
+_plant_cache = TTLCache(maxsize=512, ttl=86400)
+_plant_cache_lock = threading.Lock()
+# Bound the number of Gemini calls in flight at once
+_gemini_semaphore = asyncio.Semaphore(8)
+
+async def get_plant_info_from_gemini(plant_name: str):
     """Asks the Gemini API for details and expects a JSON response."""
     if not gemini_data_model:
         return {"error": "Gemini data model not initialized."}
+
+    with _plant_cache_lock:
+        if plant_name in _plant_cache:
+            return dict(_plant_cache[plant_name])
         
     print(f"\nAsking Gemini for info on: {plant_name}...")
-    prompt = f"""
-    Please provide the details for the plant named '{plant_name}' in the required JSON format.
-    The JSON should have these keys: "scientific_name", "common_name", "local_name", "family_name", "genus", "native_location", "medicinal_uses".
-    For "medicinal_uses", provide a brief summary. If information for any key is not found, use "N/A".
-    """
+    prompt = f"Plant: {plant_name}"
+    try:
+        async with _gemini_semaphore:
+            response = await gemini_data_model.generate_content_async(prompt)
+    except Exception as e:
+        print(f"❌ ERROR calling Gemini: {e}")
+        return {"error": f"Could not get details from AI. Error: {str(e)}", "name": plant_name}
+
+    # The response schema guarantees plain JSON, so no markdown cleanup is needed.
+    # response.text still raises on blocked/empty candidates and a MAX_TOKENS cut-off leaves truncated JSON.
     try:
-        response = gemini_data_model.generate_content(prompt)
-        # Clean the response to ensure it's valid JSON
-        clean_json_text = response.text.strip().replace('```json', '').replace('```', '')
-        data = json.loads(clean_json_text)
-        data['name'] = plant_name # Add the original name for convenience
-        return data
+        data = json.loads(response.text)
     except Exception as e:
-        print(f"❌ ERROR parsing Gemini JSON: {e}\nRaw response: {response.text}")
+        print(f"❌ ERROR parsing Gemini JSON: {e}")
         return {"error": f"Could not parse details from AI. Error: {str(e)}", "name": plant_name}
+    data['name'] = plant_name # Add the original name for convenience
+    with _plant_cache_lock:
+        _plant_cache[plant_name] = data
+    return dict(data)
+
+# --- 3.1 BLOCKING IMAGE WORK (runs in a thread pool, off the event loop) ---
+_cpu_executor = ThreadPoolExecutor(max_workers=4)
+
+# libjpeg-turbo's SIMD encoder is several times faster than OpenCV's; OpenCV is the fallback
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    jpeg_encoder = TurboJPEG()
+    print("✅ TurboJPEG encoder initialized.")
+except Exception as e:
+    print(f"⚠️ WARNING: TurboJPEG unavailable, using OpenCV for JPEG encoding. Error: {e}")
+    jpeg_encoder = None
+
+MAX_IMAGE_SIDE = 960 # YOLO letterboxes to 640 anyway, so larger uploads are shrunk up front
+
+def _decode_image(image_file):
+    """Decodes an uploaded file object into an RGB PIL image, reading it as PIL needs."""
+    pil_image = Image.open(image_file).convert("RGB")
+    if max(pil_image.size) > MAX_IMAGE_SIDE:
+        pil_image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.BILINEAR)
+    return pil_image
+
+def _run_yolo(images):
+    """Runs YOLO on a list of images."""
+    return yolo_model(images, half=YOLO_HALF, device=YOLO_DEVICE, imgsz=640, verbose=False)
+
+def _encode_annotated_image(result):
+    """Draws the detections and returns them as a Base64 JPEG, or None if encoding fails."""
+    annotated_image = result.plot()
+    # Encode straight from the BGR buffer, no RGB/PIL copies
+    if jpeg_encoder:
+        jpeg_bytes = jpeg_encoder.encode(annotated_image, quality=85, pixel_format=TJPF_BGR)
+        return base64.b64encode(jpeg_bytes).decode("utf-8")
+    ok, jpeg_buffer = cv2.imencode('.jpg', annotated_image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    if not ok:
+        return None
+    return base64.b64encode(jpeg_buffer).decode("utf-8")
+
+# --- 3.2 DYNAMIC BATCHING FOR YOLO ---
+# Requests arriving within MAX_WAIT_MS of each other are run through YOLO as one batch
+MAX_BATCH = 8
+MAX_WAIT_MS = 10
+_yolo_queue = None
+_yolo_worker_task = None
+
+async def _yolo_batch_worker():
+    """Drains the queue into batches of up to MAX_BATCH images and runs them together."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _yolo_queue.get()]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_yolo_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        images = [image for image, _ in batch]
+        try:
+            results = await loop.run_in_executor(_cpu_executor, _run_yolo, images)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+def start_yolo_batcher():
+    """Creates the batch queue and worker task on the running event loop."""
+    global _yolo_queue, _yolo_worker_task
+    _yolo_queue = asyncio.Queue()
+    _yolo_worker_task = asyncio.create_task(_yolo_batch_worker())
+
+async def stop_yolo_batcher():
+    """Cancels the worker task and any requests still waiting in the queue."""
+    global _yolo_queue, _yolo_worker_task
+    _yolo_worker_task.cancel()
+    try:
+        await _yolo_worker_task
+    except asyncio.CancelledError:
+        pass
+    while not _yolo_queue.empty():
+        _, future = _yolo_queue.get_nowait()
+        future.cancel()
+    _yolo_queue = None
+    _yolo_worker_task = None
+
+async def run_yolo_batched(image):
+    """Queues one image for batched YOLO inference and waits for its result."""
+    future = asyncio.get_running_loop().create_future()
+    await _yolo_queue.put((image, future))
+    return await future
 
 # --- 4. CREATE THE FASTAPI APP ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_yolo_model()
+    start_yolo_batcher()
+    yield
+    await stop_yolo_batcher()
+
 app = FastAPI(
     title="🌿 Medicinal Plant API",
-    description="API for detecting medicinal plants and getting information."
+    description="API for detecting medicinal plants and getting information.",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse # orjson is much faster on the large Base64 image string
 )
 
 # --- 5. CONFIGURE CORS (This is the connection!) ---
@@ -119,7 +364,7 @@ def read_root():
 
 # --- 7. API "PREDICT" ENDPOINT ---
 # This is what your React app will call
-@app.post("/predict")
+@app.post("/predict", response_model=PredictResponse)
 async def predict_plant(file: UploadFile = File(...)):
     """
     This endpoint receives an image, runs YOLO detection, gets Gemini info,
@@ -128,50 +373,48 @@ async def predict_plant(file: UploadFile = File(...)):
     if not yolo_model or not GEMINI_CONFIGURED:
         raise HTTPException(status_code=500, detail="A required model is not loaded. Check server logs.")
 
+    loop = asyncio.get_running_loop()
+
     # --- Read and process the image ---
     try:
-        contents = await file.read()
-        pil_image = Image.open(io.BytesIO(contents))
-        
-        if pil_image.mode != "RGB":
-            pil_image = pil_image.convert("RGB")
-            
+        pil_image = await loop.run_in_executor(_cpu_executor, _decode_image, file.file)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid image file: {e}")
 
     # --- Run YOLO detection ---
-    results = yolo_model(pil_image)
-    r = results[0]
+    r = await run_yolo_batched(pil_image)
 
-    # --- Get annotated image ---
-    annotated_image = r.plot() 
-    annotated_image_rgb = cv2.cvtColor(annotated_image, cv2.COLOR_BGR2RGB)
-    
-    # --- Encode image to Base64 ---
-    pil_img_annotated = Image.fromarray(annotated_image_rgb)
-    buffered = io.BytesIO()
-    pil_img_annotated.save(buffered, format="JPEG")
-    base64_image_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    # --- Get annotated image and encode it to Base64 ---
+    base64_image_str = await loop.run_in_executor(_cpu_executor, _encode_annotated_image, r)
+    if base64_image_str is None:
+        raise HTTPException(status_code=500, detail="Could not encode the annotated image.")
 
     # --- Get detected plant names and Gemini info ---
-    detected_names = [yolo_model.names[int(class_id)] for class_id in r.boxes.cls]
-    unique_detected_names = sorted(list(set(detected_names)))
+    class_ids = r.boxes.cls.to(torch.int32).tolist()  # one device->host copy for all boxes
+    detected_names = [YOLO_CLASS_NAMES[i] for i in class_ids]
+    unique_detected_names = list(dict.fromkeys(detected_names))  # dedupe, keeping detection order
     
     plant_data_list = []
     if not unique_detected_names:
         plant_data_list.append({"name": "No plant detected", "error": "No plant was recognized in the image."})
     else:
-        for name in unique_detected_names:
-            plant_info = get_plant_info_from_gemini(name)
-            plant_data_list.append(plant_info)
+        # Query Gemini for every species concurrently instead of one after another
+        plant_data_list = await asyncio.gather(
+            *[get_plant_info_from_gemini(name) for name in unique_detected_names]
+        )
 
     # --- Return the final JSON response ---
-    return {
-        "annotated_image": base64_image_str,
-        "plant_data": plant_data_list
-    }
+    return PredictResponse(
+        annotated_image=base64_image_str,
+        plant_data=plant_data_list
+    )
 
 # --- 8. API "CHAT" ENDPOINT ---
+# One (lock, Gemini chat session) pair per client session, dropped after 30 minutes idle.
+# The lock stops overlapping turns from interleaving the session history; the session
+# stays None until its first turn succeeds.
+_chat_sessions = TTLCache(maxsize=10_000, ttl=1800)
+
 @app.post("/chat")
 async def chat_with_bot(request: ChatRequest):
     """
@@ -183,18 +426,46 @@ async def chat_with_bot(request: ChatRequest):
 
     print(f"\nChatting about: {request.plant_name}. User asked: {request.message}")
     
-    chat_session = gemini_chat_model.start_chat()
-    prompt = f"The user has just identified a '{request.plant_name}'. They are now asking: '{request.message}'. Please answer their question."
-    
-    try:
-        response = chat_session.send_message(prompt)
-        return {"response": response.text}
-    except Exception as e:
-        print(f"❌ ERROR in chat endpoint: {e}")
-        raise HTTPException(status_code=500, detail=f"Error processing chat: {e}")
+    # Store the lock right away (no await in between) so concurrent first turns share it
+    if request.session_id not in _chat_sessions:
+        _chat_sessions[request.session_id] = (asyncio.Lock(), None)
+    session_lock, _ = _chat_sessions[request.session_id]
+
+    async with session_lock:
+        # Re-read under the lock (a previous turn may have just stored the session) and
+        # re-set the entry so the lock and session always expire together
+        _, chat_session = _chat_sessions.get(request.session_id, (session_lock, None))
+        _chat_sessions[request.session_id] = (session_lock, chat_session)
+
+        # Reuse the conversation for this session; only its first turn needs the plant context
+        if chat_session is None:
+            chat_session = gemini_chat_model.start_chat()
+            prompt = f"The user has just identified a '{request.plant_name}'. They are now asking: '{request.message}'. Please answer their question."
+        else:
+            prompt = request.message
+        
+        try:
+            response = await chat_session.send_message_async(prompt)
+            reply = response.text
+        except Exception as e:
+            print(f"❌ ERROR in chat endpoint: {e}")
+            raise HTTPException(status_code=500, detail=f"Error processing chat: {e}")
+
+        # Only keep the session once a turn has succeeded, so a failed first turn is primed again
+        _chat_sessions[request.session_id] = (session_lock, chat_session)
+        return {"response": reply}
 
 # --- 9. RUN THE APP (if this file is run directly) ---
 if __name__ == "__main__":
     print("Starting FastAPI server... Access it at http://localhost:8000")
-    uvicorn.run(app, host="localhost", port=8000)
+    # Build the TensorRT engine once here, before any worker starts; workers only load it
+    build_tensorrt_engine()
+    uvicorn.run(
+        "main:app",
+        host="localhost",
+        port=8000,
+        workers=get_worker_count(),
+        loop="auto", # uvloop when installed (not on Windows), asyncio otherwise
+        http="httptools"
+    )
 